@@ -1,13 +1,21 @@
 #!/usr/bin/env python3
+import asyncio
+import functools
+import io
+import math
 import os
 import re
-import psycopg2
-from psycopg2.extras import DictCursor
-from datetime import datetime
+import threading
+import time
+import aiohttp
+import asyncpg
+from cachetools import TTLCache, cached
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
 import instaloader
-from urllib.parse import urlparse
-from telegram import Update
+from telegram import InputMediaPhoto, InputMediaVideo, Update
+from telegram.error import BadRequest
 from telegram.ext import (
     ApplicationBuilder,
     CommandHandler,
@@ -20,7 +28,7 @@ from telegram.ext import (
 load_dotenv()
 BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 ADMIN_IDS_RAW = os.getenv("ADMIN_IDS", "")
-ADMIN_IDS = [int(x.strip()) for x in ADMIN_IDS_RAW.split(",") if x.strip()]
+ADMIN_IDS = frozenset(int(x.strip()) for x in ADMIN_IDS_RAW.split(",") if x.strip())
 
 if not BOT_TOKEN:
     raise SystemExit("Missing TELEGRAM_BOT_TOKEN in .env")
@@ -30,129 +38,346 @@ DB_URL = os.getenv("DATABASE_URL")
 if not DB_URL:
     raise SystemExit("DATABASE_URL not set in .env")
 
-def init_db():
-    conn = psycopg2.connect(DB_URL)
-    cur = conn.cursor()
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS logs (
-        id SERIAL PRIMARY KEY,
-        user_id BIGINT,
-        username TEXT,
-        first_name TEXT,
-        link TEXT,
-        media_pk TEXT,
-        created_at TIMESTAMP
-    )
-    """)
-    conn.commit()
-    conn.close()
+POOL = None
+LOG_TOTAL = 0
+
+async def init_db():
+    global POOL, LOG_TOTAL
+    POOL = await asyncpg.create_pool(DB_URL, min_size=2, max_size=20)
+    async with POOL.acquire() as conn:
+        await conn.execute("""
+        CREATE TABLE IF NOT EXISTS logs (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT,
+            username TEXT,
+            first_name TEXT,
+            link TEXT,
+            media_pk TEXT,
+            created_at TIMESTAMP DEFAULT (now() AT TIME ZONE 'utc')
+        )
+        """)
+        await conn.execute(
+            "ALTER TABLE logs ALTER COLUMN created_at SET DEFAULT (now() AT TIME ZONE 'utc')"
+        )
+        await conn.execute("CREATE INDEX IF NOT EXISTS logs_link_id_idx ON logs (link, id DESC)")
+        await conn.execute("CREATE INDEX IF NOT EXISTS logs_user_id_idx ON logs (user_id)")
+        await conn.execute("""
+        CREATE TABLE IF NOT EXISTS media (
+            shortcode TEXT PRIMARY KEY,
+            kinds TEXT[] NOT NULL,
+            file_ids TEXT[] NOT NULL,
+            caption TEXT
+        )
+        """)
+        LOG_TOTAL = await conn.fetchval("SELECT COUNT(*) FROM logs")
+
+LOG_COLUMNS = ("user_id", "username", "first_name", "link", "media_pk")
+LOG_BATCH_SIZE = 500
+LOG_FLUSH_INTERVAL = 2.0
+LOG_QUEUE = None
+log_flusher_task = None
+
+async def write_logs(rows):
+    async with POOL.acquire() as conn:
+        await conn.copy_records_to_table("logs", records=rows, columns=LOG_COLUMNS)
 
 def add_log(user_id, username, first_name, link, media_pk):
-    conn = psycopg2.connect(DB_URL)
-    cur = conn.cursor()
-    cur.execute(
-        "INSERT INTO logs (user_id, username, first_name, link, media_pk, created_at) VALUES (%s, %s, %s, %s, %s, %s)",
-        (user_id, username, first_name, link, media_pk, datetime.utcnow())
-    )
-    conn.commit()
-    conn.close()
-
-def get_stats():
-    conn = psycopg2.connect(DB_URL)
-    cur = conn.cursor(cursor_factory=DictCursor)
-    cur.execute("SELECT COUNT(*) FROM logs")
-    total = cur.fetchone()[0]
-    cur.execute("SELECT COUNT(DISTINCT user_id) FROM logs")
-    unique_users = cur.fetchone()[0]
-    cur.execute("""
-        SELECT user_id, username, first_name, COUNT(*) as cnt 
-        FROM logs 
-        GROUP BY user_id, username, first_name 
-        ORDER BY cnt DESC LIMIT 10
-    """)
-    top = cur.fetchall()
-    conn.close()
-    return {"total": total, "unique_users": unique_users, "top": top}
-
-def get_logs(limit=100):
-    conn = psycopg2.connect(DB_URL)
-    cur = conn.cursor()
-    cur.execute("SELECT id, user_id, username, first_name, link, media_pk, created_at FROM logs ORDER BY id DESC LIMIT %s", (limit,))
-    rows = cur.fetchall()
-    conn.close()
-    return rows
-
-def get_links(limit=100):
-    conn = psycopg2.connect(DB_URL)
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT link FROM logs
-        GROUP BY link
-        ORDER BY MAX(id) DESC
-        LIMIT %s
-    """, (limit,))
-    rows = [r[0] for r in cur.fetchall()]
-    conn.close()
-    return rows
+    row = (user_id, username, first_name, link, media_pk)
+    try:
+        LOG_QUEUE.put_nowait(row)
+    except asyncio.QueueFull:
+        print("⚠️ Log navbati to‘lgan, yozuv tashlab yuborildi")
+
+async def flush_logs(rows):
+    global LOG_TOTAL
+    try:
+        await write_logs(rows)
+    except Exception as e:
+        print(f"❌ Loglarni yozishda xatolik: {e}")
+        return
+    LOG_TOTAL += len(rows)
+
+async def log_flusher():
+    loop = asyncio.get_running_loop()
+    while True:
+        row = await LOG_QUEUE.get()
+        if row is None:
+            return
+        rows = [row]
+        deadline = loop.time() + LOG_FLUSH_INTERVAL
+        while len(rows) < LOG_BATCH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                row = await asyncio.wait_for(LOG_QUEUE.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if row is None:
+                await flush_logs(rows)
+                return
+            rows.append(row)
+        await flush_logs(rows)
+
+async def get_stats():
+    async with POOL.acquire() as conn:
+        rows = await conn.fetch("""
+            WITH totals AS (
+                SELECT COUNT(DISTINCT user_id) AS unique_users
+                FROM logs
+            )
+            SELECT t.unique_users, top.user_id, top.username, top.first_name, top.cnt
+            FROM totals t
+            LEFT JOIN LATERAL (
+                SELECT user_id, username, first_name, COUNT(*) as cnt
+                FROM logs
+                GROUP BY user_id, username, first_name
+                ORDER BY cnt DESC LIMIT 10
+            ) top ON TRUE
+        """)
+    top = [tuple(r)[1:] for r in rows if r["cnt"] is not None]
+    return {"total": LOG_TOTAL, "unique_users": rows[0]["unique_users"], "top": top}
+
+async def get_logs(limit=100):
+    async with POOL.acquire() as conn:
+        return await conn.fetch("SELECT id, user_id, username, first_name, link, media_pk, created_at FROM logs ORDER BY id DESC LIMIT $1", limit)
+
+async def get_links(limit=100):
+    async with POOL.acquire() as conn:
+        rows = await conn.fetch("""
+            SELECT link FROM (
+                SELECT DISTINCT ON (link) link, id
+                FROM logs
+                ORDER BY link, id DESC
+            ) latest
+            ORDER BY id DESC
+            LIMIT $1
+        """, limit)
+    return [r[0] for r in rows]
+
+MEDIA_CACHE = OrderedDict()
+MEDIA_CACHE_SIZE = 10000
+
+def cache_media(shortcode, media):
+    MEDIA_CACHE[shortcode] = media
+    MEDIA_CACHE.move_to_end(shortcode)
+    if len(MEDIA_CACHE) > MEDIA_CACHE_SIZE:
+        MEDIA_CACHE.popitem(last=False)
+
+async def get_media(shortcode):
+    media = MEDIA_CACHE.get(shortcode)
+    if media:
+        MEDIA_CACHE.move_to_end(shortcode)
+        return media
+    async with POOL.acquire() as conn:
+        row = await conn.fetchrow("SELECT kinds, file_ids, caption FROM media WHERE shortcode = $1", shortcode)
+    if not row:
+        return None
+    media = {"media": list(zip(row["kinds"], row["file_ids"])), "caption": row["caption"]}
+    cache_media(shortcode, media)
+    return media
+
+async def save_media(shortcode, media, caption):
+    kinds = [kind for kind, _ in media]
+    file_ids = [file_id for _, file_id in media]
+    async with POOL.acquire() as conn:
+        await conn.execute(
+            "INSERT INTO media (shortcode, kinds, file_ids, caption) VALUES ($1, $2, $3, $4) ON CONFLICT (shortcode) DO NOTHING",
+            shortcode, kinds, file_ids, caption,
+        )
+    cache_media(shortcode, {"media": media, "caption": caption})
+
+async def delete_media(shortcode):
+    MEDIA_CACHE.pop(shortcode, None)
+    async with POOL.acquire() as conn:
+        await conn.execute("DELETE FROM media WHERE shortcode = $1", shortcode)
+
+# ====== Instagram ======
+IG_USER = os.getenv("IG_USER")
+IG_PASS = os.getenv("IG_PASS")
+IG_SESSION_FILE = os.getenv("IG_SESSION_FILE", "ig_session")
+L = instaloader.Instaloader()
+
+def login():
+    if not IG_USER:
+        return
+    if not IG_PASS:
+        raise SystemExit("IG_USER is set but IG_PASS is missing in .env")
+    try:
+        L.load_session_from_file(IG_USER, IG_SESSION_FILE)
+    except FileNotFoundError:
+        pass
+    else:
+        try:
+            username = L.test_login()
+        except instaloader.ConnectionException as e:
+            # Network trouble or a 429 says nothing about the session itself.
+            print(f"⚠️ Instagram sessiyasini tekshirib bo‘lmadi, saqlangan sessiya ishlatiladi: {e}")
+            return
+        if username and username.lower() == IG_USER.lower():
+            return
+    L.login(IG_USER, IG_PASS)
+    L.save_session_to_file(IG_SESSION_FILE)
+
+IG_RATE_LIMIT = 180
+IG_RATE_WINDOW = 3600
+IG_REQUESTS = deque(maxlen=IG_RATE_LIMIT)
+IG_REQUESTS_LOCK = threading.Lock()
+
+def acquire_ig_slot():
+    now = time.monotonic()
+    with IG_REQUESTS_LOCK:
+        while IG_REQUESTS and now - IG_REQUESTS[0] >= IG_RATE_WINDOW:
+            IG_REQUESTS.popleft()
+        if len(IG_REQUESTS) >= IG_RATE_LIMIT:
+            minutes = math.ceil((IG_RATE_WINDOW - (now - IG_REQUESTS[0])) / 60)
+            raise Exception(f"Instagram so‘rovlar limiti tugadi, {minutes} daqiqadan so‘ng qayta urinib ko‘ring.")
+        IG_REQUESTS.append(now)
 
 # ====== Helpers ======
-URL_RE = re.compile(r"(https?://[^\s]+)")
+CONCURRENT_UPDATES = 64
+IG_SEMAPHORE = asyncio.Semaphore(8)
+FETCH_LOCKS = {}
+
+@asynccontextmanager
+async def fetch_lock(shortcode):
+    entry = FETCH_LOCKS.setdefault(shortcode, [asyncio.Lock(), 0])
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if not entry[1]:
+            del FETCH_LOCKS[shortcode]
 
-def extract_url(text: str):
-    m = URL_RE.search(text)
-    return m.group(1) if m else None
+HASHTAG_RE = re.compile(r"#\w+")
+MENTION_RE = re.compile(r"@\w+")
+SHORTCODE_RE = re.compile(r"(?i:instagram\.com|instagr\.am)/(?:p|reels?|tv)/([A-Za-z0-9_-]+)")
 
 def extract_tags_and_mentions(caption: str):
-    hashtags = re.findall(r"#\w+", caption or "")
-    mentions = re.findall(r"@\w+", caption or "")
+    hashtags = HASHTAG_RE.findall(caption or "")
+    mentions = MENTION_RE.findall(caption or "")
     return hashtags, mentions
 
 def is_admin(user_id: int) -> bool:
     return user_id in ADMIN_IDS
 
 def get_shortcode_from_url(url):
-    path = urlparse(url).path
-    parts = path.strip('/').split('/')
-    if len(parts) >= 2:
-        return parts[1]
-    return None
-
-def get_instagram_post_info(url):
-    L = instaloader.Instaloader()
-    shortcode = get_shortcode_from_url(url)
-    if not shortcode:
-        raise Exception("URL dan shortcode olinmadi")
+    m = SHORTCODE_RE.search(url)
+    return m.group(1) if m else None
 
+@cached(TTLCache(maxsize=2048, ttl=3600), lock=threading.Lock())
+def get_instagram_post_info(shortcode):
+    acquire_ig_slot()
     post = instaloader.Post.from_shortcode(L.context, shortcode)
 
-    caption = post.caption or ""
-    hashtags, mentions = extract_tags_and_mentions(caption)
-
-    media_type = "photo"
-    media_urls = []
-
+    media = []
     if post.is_video:
-        media_type = "video"
-        media_urls.append(post.video_url)
+        media.append(("video", post.video_url))
     elif post.typename == "GraphSidecar":
-        media_type = "album"
         for node in post.get_sidecar_nodes():
             if node.is_video:
-                media_urls.append(node.video_url)
+                media.append(("video", node.video_url))
             else:
-                media_urls.append(node.display_url)
+                media.append(("photo", node.display_url))
     else:
-        media_urls.append(post.url)
+        media.append(("photo", post.url))
 
-    return {
-        "media_type": media_type,
-        "media_urls": media_urls,
-        "caption": caption,
-        "hashtags": hashtags,
-        "mentions": mentions,
-    }
+    return {"media": media, "caption": post.caption or ""}
+
+def format_caption(caption):
+    hashtags, mentions = extract_tags_and_mentions(caption)
+    return (
+        f"📄 Caption:\n{caption or '(yo‘q)'}\n\n"
+        f"🏷 Hashtags: {' '.join(hashtags) if hashtags else 'Yo‘q'}\n"
+        f"👤 Mentions: {' '.join(mentions) if mentions else 'Yo‘q'}"
+    )
+
+MEDIA_GROUP_LIMIT = 10
+
+def sent_file(message):
+    # Telegram may turn a silent video into an animation (or a document),
+    # so keep whatever kind it actually stored for resending.
+    if message.photo:
+        return "photo", message.photo[-1].file_id
+    if message.video:
+        return "video", message.video.file_id
+    if message.animation:
+        return "animation", message.animation.file_id
+    return "document", message.document.file_id
+
+HTTP_SESSION = None
+
+UPLOAD_LIMIT = 50 * 1024 * 1024
+TOO_LARGE_MESSAGE = "Fayl 50 MB dan katta, uni Telegram orqali yuborib bo‘lmaydi."
+
+async def download_media(url):
+    async with HTTP_SESSION.get(url) as resp:
+        resp.raise_for_status()
+        if resp.content_length and resp.content_length > UPLOAD_LIMIT:
+            raise Exception(TOO_LARGE_MESSAGE)
+        data = bytearray()
+        async for part in resp.content.iter_chunked(64 * 1024):
+            data.extend(part)
+            if len(data) > UPLOAD_LIMIT:
+                raise Exception(TOO_LARGE_MESSAGE)
+        return bytes(data)
+
+async def send_chunk(message, chunk):
+    if len(chunk) == 1:
+        kind, item = chunk[0]
+        if kind == "video":
+            return [await message.reply_video(video=item)]
+        if kind == "animation":
+            return [await message.reply_animation(animation=item)]
+        if kind == "document":
+            return [await message.reply_document(document=item)]
+        return [await message.reply_photo(photo=item)]
+    group = [
+        InputMediaVideo(media=item) if kind == "video" else InputMediaPhoto(media=item)
+        for kind, item in chunk
+    ]
+    return await message.reply_media_group(media=group)
+
+async def send_media(message, media, sent):
+    # Appends (kind, file_id) to sent after each chunk, so a caller that
+    # catches an error still knows which items were already delivered.
+    for i in range(0, len(media), MEDIA_GROUP_LIMIT):
+        chunk = media[i:i + MEDIA_GROUP_LIMIT]
+        try:
+            replies = await send_chunk(message, chunk)
+        except BadRequest:
+            # Telegram could not fetch the CDN URL itself (e.g. videos over 20 MB),
+            # so download the files and upload them directly.
+            if not all(item.startswith("http") for _, item in chunk):
+                raise
+            data = await asyncio.gather(*(download_media(item) for _, item in chunk))
+            replies = await send_chunk(message, [(kind, d) for (kind, _), d in zip(chunk, data)])
+        sent.extend(sent_file(reply) for reply in replies)
+
+def is_stale_file_id(error):
+    text = str(error).lower()
+    return "file identifier" in text or "file_id" in text
 
 # ====== Handlers ======
+TEXT_LIMIT = 4096
+
+async def reply_long_text(message, text, filename):
+    if len(text.encode("utf-16-le")) // 2 <= TEXT_LIMIT:
+        await message.reply_text(text)
+    else:
+        await message.reply_document(document=io.BytesIO(text.encode()), filename=filename)
+
+def admin_only(handler):
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if not is_admin(update.effective_user.id):
+            await update.message.reply_text("❌ Bu buyruq faqat adminlarga mo‘ljallangan.")
+            return
+        return await handler(update, context)
+    return wrapper
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
         "👋 Salom! Instagram link yuboring (post yoki reel). Men media va captionni yuboraman."
@@ -174,81 +399,79 @@ async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
     await update.message.reply_text(help_text)
 
+@admin_only
 async def stats_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user = update.effective_user
-    if not is_admin(user.id):
-        await update.message.reply_text("❌ Bu buyruq faqat adminlarga mo‘ljallangan.")
-        return
-    s = get_stats()
-    text = f"📊 Statistika\nUmumiy linklar: {s['total']}\nFoydalanuvchi soni: {s['unique_users']}\n\nTop yuboruvchilar:\n"
-    for row in s["top"]:
-        uid, uname, fname, cnt = row
-        text += f"- {fname or uname or uid} ({uname or ''}) : {cnt}\n"
-    await update.message.reply_text(text)
+    s = await get_stats()
+    header = f"📊 Statistika\nUmumiy linklar: {s['total']}\nFoydalanuvchi soni: {s['unique_users']}\n\nTop yuboruvchilar:\n"
+    top_lines = "".join(
+        f"- {fname or uname or uid} ({uname or ''}) : {cnt}\n"
+        for uid, uname, fname, cnt in s["top"]
+    )
+    await update.message.reply_text(header + top_lines)
 
+@admin_only
 async def logs_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user = update.effective_user
-    if not is_admin(user.id):
-        await update.message.reply_text("❌ Bu buyruq faqat adminlarga mo‘ljallangan.")
-        return
     limit = 50
     if context.args and context.args[0].isdigit():
         limit = min(500, int(context.args[0]))
-    rows = get_logs(limit)
+    rows = await get_logs(limit)
     if not rows:
         await update.message.reply_text("Logs mavjud emas.")
         return
-    text_lines = []
-    for r in rows:
-        _id, uid, uname, fname, link, media_pk, created_at = r
-        text_lines.append(f"[{created_at}] {fname or ''} ({uname or uid}) → {link}")
-    await update.message.reply_text("\n".join(text_lines))
+    text = "\n".join(
+        f"[{created_at}] {fname or ''} ({uname or uid}) → {link}"
+        for _id, uid, uname, fname, link, media_pk, created_at in rows
+    )
+    await reply_long_text(update.message, text, "logs.txt")
 
+@admin_only
 async def links_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user = update.effective_user
-    if not is_admin(user.id):
-        await update.message.reply_text("❌ Bu buyruq faqat adminlarga mo‘ljallangan.")
-        return
-    rows = get_links(200)
+    rows = await get_links(200)
     if not rows:
         await update.message.reply_text("Linklar mavjud emas.")
         return
-    await update.message.reply_text("\n".join(rows))
+    await reply_long_text(update.message, "\n".join(rows), "links.txt")
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     text = (update.message.text or "").strip()
-    url = extract_url(text)
-    if not url:
+    low = text.lower()
+    shortcode = None
+    if "instagram.com" in low or "instagr.am" in low:
+        shortcode = get_shortcode_from_url(text)
+    if not shortcode:
         await update.message.reply_text("Iltimos, Instagram post yoki reel linkini yuboring.")
         return
+    url = f"https://www.instagram.com/p/{shortcode}/"
 
     msg = await update.message.reply_text("🔎 Instagram ma'lumot olinayapti... iltimos kuting")
     try:
-        info = get_instagram_post_info(url)
-
-        add_log(user.id, user.username or "", user.first_name or "", url, "")
-
-        caption_text = (
-            f"📄 Caption:\n{info['caption'] or '(yo‘q)'}\n\n"
-            f"🏷 Hashtags: {' '.join(info['hashtags']) if info['hashtags'] else 'Yo‘q'}\n"
-            f"👤 Mentions: {' '.join(info['mentions']) if info['mentions'] else 'Yo‘q'}"
-        )
-
-        if info["media_type"] == "photo":
-            await update.message.reply_photo(photo=info["media_urls"][0])
-        elif info["media_type"] == "video":
-            await update.message.reply_video(video=info["media_urls"][0])
-        elif info["media_type"] == "album":
-            for media_url in info["media_urls"]:
-                if media_url.endswith(('.mp4', '.mov')):
-                    await update.message.reply_video(video=media_url)
-                else:
-                    await update.message.reply_photo(photo=media_url)
-        else:
-            await update.message.reply_text("❌ Media topilmadi yoki qo‘llab-quvvatlanmaydi.")
-
-        await update.message.reply_text(caption_text)
+        async with fetch_lock(shortcode):
+            sent = []
+            cached_media = await get_media(shortcode)
+            if cached_media:
+                try:
+                    await send_media(update.message, cached_media["media"], sent)
+                    caption = cached_media["caption"]
+                except BadRequest as e:
+                    if not is_stale_file_id(e):
+                        raise
+                    await delete_media(shortcode)
+                    cached_media = None
+            if not cached_media:
+                async with IG_SEMAPHORE:
+                    info = await asyncio.to_thread(get_instagram_post_info, shortcode)
+                if not info["media"]:
+                    await msg.edit_text("❌ Media topilmadi yoki qo‘llab-quvvatlanmaydi.")
+                    return
+                # Chunks already delivered from the cache are not sent again.
+                await send_media(update.message, info["media"][len(sent):], sent)
+                await save_media(shortcode, sent, info["caption"])
+                caption = info["caption"]
+
+        add_log(user.id, user.username or "", user.first_name or "", url, shortcode)
+
+        await update.message.reply_text(format_caption(caption))
         await msg.delete()
 
     except Exception as e:
@@ -258,9 +481,44 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text(f"❌ Xatolik: {e}")
 
 # ====== Main ======
+async def post_init(app):
+    global LOG_QUEUE, log_flusher_task, HTTP_SESSION
+    await init_db()
+    HTTP_SESSION = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit_per_host=8, ttl_dns_cache=300)
+    )
+    LOG_QUEUE = asyncio.Queue(maxsize=10 * LOG_BATCH_SIZE)
+    log_flusher_task = asyncio.create_task(log_flusher())
+
+async def post_shutdown(app):
+    # Also runs when startup failed halfway, so any of these may be missing.
+    if LOG_QUEUE is not None and log_flusher_task is not None:
+        await LOG_QUEUE.put(None)
+        await log_flusher_task
+    if HTTP_SESSION is not None:
+        await HTTP_SESSION.close()
+    if POOL is not None:
+        await POOL.close()
+
 def main():
-    init_db()
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+    try:
+        import uvloop
+    except ImportError:
+        pass
+    else:
+        # uvloop.install() is deprecated on Python 3.12+; setting the loop
+        # directly works on every supported version and run_polling picks it up.
+        asyncio.set_event_loop(uvloop.new_event_loop())
+
+    login()
+    app = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .build()
+    )
 
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("help", help_cmd))